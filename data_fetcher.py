@@ -1,21 +1,115 @@
 """Get any necessary data for given symbols"""
 
+import json
 import os
+import time
+
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import pandas as pd
 import pycharts
+from pycharts import exceptions
+import requests
+
+# Shared session so repeated get_points calls reuse one pooled
+# keep-alive connection to the YCharts API.
+_SESSION = requests.Session()
+
+
+class FileCache(object):
+    """On-disk cache of YCharts field values keyed by (symbol, field).
+    Each entry is a small json file under the cache directory holding
+    the fetch timestamp and the cached value."""
+
+    def __init__(self, cache_dir=os.path.join('.cache', 'ycharts')):
+        self.cache_dir = cache_dir
+
+    def _entry_path(self, symbol, field):
+        return os.path.join(self.cache_dir, symbol, field + '.json')
+
+    def get(self, symbol, field, ttl):
+        """Return the cached value for (symbol, field), or None if
+        there is no entry, the entry is unreadable, or the entry is
+        older than ttl seconds."""
+        path = self._entry_path(symbol, field)
+        if not os.path.exists(path):
+            return None
+        with open(path) as entry_file:
+            try:
+                entry = json.load(entry_file)
+            except ValueError:
+                # A run killed mid-write leaves a truncated entry;
+                # treat it as a miss so the next set() rewrites it
+                return None
+        if time.time() - entry['timestamp'] > ttl:
+            return None
+        return entry['value']
+
+    def set(self, symbol, field, value):
+        """Store value for (symbol, field) with the current time."""
+        path = self._entry_path(symbol, field)
+        dir_name = os.path.dirname(path)
+        if not os.path.isdir(dir_name):
+            os.makedirs(dir_name)
+        with open(path, 'w') as entry_file:
+            json.dump({'timestamp': time.time(), 'value': value},
+                      entry_file)
 
 
 class CompanyClient(pycharts.CompanyClient):
     """Child Class of pycharts Company Client that adds additional methods
     to make it more convenient to get data from the YCharts API"""
-    def __init__(self, symbol_list):
+
+    # YCharts caps the number of symbols allowed per request
+    BATCH_SIZE = 100
+
+    # Time-to-live (seconds) of cached field values; slow-moving
+    # fields keep longer than prices.
+    DEFAULT_TTL = 6 * 60 * 60
+    FIELD_TTLS = {'price': 6 * 60 * 60,
+                  'average_volume_30': 7 * 24 * 60 * 60}
+
+    def __init__(self, symbol_list, cache_ttls=None):
         YCHARTS_API_KEY = os.environ['YCHARTS_API_KEY']
         super(CompanyClient, self).__init__(YCHARTS_API_KEY)
         if isinstance(symbol_list, basestring):
             symbol_list = [symbol_list]
         self.symbol_list = map(str.upper, symbol_list)
+        self.cache = FileCache()
+        self.cache_ttls = cache_ttls if cache_ttls is not None \
+            else self.FIELD_TTLS
+
+    def _get_data(self, url_path, params=None):
+        """Same request as the parent implementation, but issued
+        through the shared requests.Session rather than a one-shot
+        urllib connection."""
+        url = '{0}/{1}/{2}'.format(self.BASE_URL, self.API_VERSION,
+                                   url_path)
+        url = url.replace(' ', '')
+        response = _SESSION.get(url, params=params, headers=self.header)
+
+        if response.status_code == 404:
+            raise exceptions.PyChartsRequestUrlNotFoundException()
+        elif response.status_code == 401:
+            raise exceptions.PyChartsRequestUnauthorizedException()
+        elif response.status_code == 400:
+            raise exceptions.PyChartsRequestException()
+        response.raise_for_status()
+
+        parsed_rsp = response.json()
+        # raise any payload level errors
+        if parsed_rsp['meta']['status'] == 'error':
+            error_code = parsed_rsp['meta']['error_code']
+            error_message = parsed_rsp['meta']['error_message']
+            if error_code == 400:
+                raise exceptions.PyChartsRequestException(
+                    error_message=error_message)
+            elif error_code == 414:
+                raise exceptions.PyChartsRequestTooLongException(
+                    error_message=error_message)
+
+        return parsed_rsp
 
     def fetch_data(self, fields):
         """Fetch data for given fields
@@ -32,24 +126,40 @@ class CompanyClient(pycharts.CompanyClient):
              symbol_2: {field1: data1, field2: data2}
              }
         """
-        n_symbols = len(self.symbol_list)
-        n_iters = n_symbols // 100 + 1
-
-        # data_dict keyed by symbol
+        # Serve symbols whose fields are all cached and still fresh
+        # without touching the API.
         data_dict = {}
-        for i in range(0, n_iters):
-            start = i*100
-            end = (i+1) * 100
-            response = self.get_points(self.symbol_list[start:end],
-                                       fields)['response']
+        to_fetch = []
+        for symbol in self.symbol_list:
+            cached = {}
+            for field in fields:
+                ttl = self.cache_ttls.get(field, self.DEFAULT_TTL)
+                value = self.cache.get(symbol, field, ttl)
+                if value is not None:
+                    cached[field] = value
+            if len(cached) == len(fields):
+                data_dict[symbol] = cached
+            else:
+                to_fetch.append(symbol)
+
+        batches = [to_fetch[i:i + self.BATCH_SIZE]
+                   for i in range(0, len(to_fetch), self.BATCH_SIZE)]
+
+        # Each batch is an independent network request, so fan them
+        # out across threads and merge the responses afterwards.
+        get_batch = lambda batch: self.get_points(batch, fields)['response']
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            responses = list(executor.map(get_batch, batches))
 
+        for response in responses:
             for symbol in response:
                 if response[symbol]['meta']['status'] == 'ok':
                     symbol_data = response[symbol]['results']
                     data_dict[symbol] = {}
                     for data_point in symbol_data:
-                        data_dict[symbol][data_point] = \
-                            symbol_data[data_point]['data'][1]
+                        value = symbol_data[data_point]['data'][1]
+                        data_dict[symbol][data_point] = value
+                        self.cache.set(symbol, data_point, value)
                 else:
                     data_dict[symbol] = {field:np.nan for field in fields}
         return data_dict
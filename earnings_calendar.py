@@ -2,22 +2,95 @@
  https://www.earningswhispers.com. It pulls the symbols, dates,
  and times for the companies reporting earnings."""
 
-import csv
 import datetime as dt
+import errno
+import io
+import json
 import os
+import re
 import sys, getopt
+import time
 
-from bs4 import BeautifulSoup
+from concurrent.futures import ThreadPoolExecutor
+
+from lxml import html
+import numpy as np
 import pandas as pd
 from pandas.tseries.offsets import BDay
 import requests
 
 import data_fetcher
 
+_UA = ('Mozilla/5.0 (Windows NT 6.1; Win64; x64)'
+       'AppleWebKit/537.36 (KHTML, like Gecko) '
+       'Chrome/67.0.3396.99 Safari/537.36')
+_CAL_URL = r'https://www.earningswhispers.com/calendar'
+_MORE_URL = r'https://www.earningswhispers.com/morecalendar'
+
+# Shared session so every page fetch reuses one pooled keep-alive
+# connection instead of paying a fresh TLS handshake per request.
+_SESSION = requests.Session()
+_SESSION.headers.update({'User-Agent': _UA})
+
+# Fetched calendar pages are kept on disk so quick re-runs (and
+# retries after a failure) do not re-download unchanged pages.
+_CACHE_DIR = os.path.join('.cache', 'calendar')
+_CACHE_TTL = 10 * 60  # seconds a cached page stays fresh
+
+def _ensure_cache_dir():
+    """Create the cache directory, tolerating a concurrent create
+    from another fetch thread (Python 2 makedirs has no exist_ok)."""
+    try:
+        os.makedirs(_CACHE_DIR)
+    except OSError as err:
+        if err.errno != errno.EEXIST:
+            raise
+
+def _cache_path(day_num, show_more):
+    """Return the cache file path for a calendar page request."""
+    suffix = '_more' if show_more else ''
+    return os.path.join(_CACHE_DIR,
+                        '{0}{1}.html'.format(day_num, suffix))
+
+def _meta_path(cache_path):
+    """Return the path of the validator metadata file for a cached
+    page (stores the ETag/Last-Modified headers of the copy)."""
+    return os.path.splitext(cache_path)[0] + '.meta.json'
+
+def _read_cache(cache_path):
+    with io.open(cache_path, encoding='utf-8') as cached:
+        return cached.read()
+
+def _conditional_headers(cache_path):
+    """Build If-None-Match/If-Modified-Since headers from the cached
+    page's validator metadata, so the server can answer 304 instead
+    of resending an unchanged body."""
+    headers = {}
+    meta_path = _meta_path(cache_path)
+    if os.path.exists(meta_path):
+        with open(meta_path) as meta_file:
+            try:
+                meta = json.load(meta_file)
+            except ValueError:
+                # Truncated by an interrupted run; fetch without
+                # validators and the next write replaces it
+                return headers
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+    return headers
+
 def _get_page(day_num, show_more=False):
     """Gets the earnings calendar html page for the
     day at today plus day_num days
 
+    Pages fetched within the last _CACHE_TTL seconds are served from
+    the on-disk cache. Older cached copies are revalidated with a
+    conditional request, so an unchanged page costs a 304 instead of
+    a full download; if the request fails, the last cached copy is
+    returned even when stale.
+
     Parameters:
     -----------
     day_num: int
@@ -28,18 +101,55 @@ def _get_page(day_num, show_more=False):
     string
         html page text
     """
+    cache_path = _cache_path(day_num, show_more)
+    cached_exists = os.path.exists(cache_path)
+    if cached_exists:
+        age = time.time() - os.path.getmtime(cache_path)
+        if age < _CACHE_TTL:
+            return _read_cache(cache_path)
+
     if show_more:
-        url = r'https://www.earningswhispers.com/morecalendar'
+        url = _MORE_URL
         params={'sb':'p', 'd':day_num, 'v':'t'}
     else:
-        url = r'https://www.earningswhispers.com/calendar'
+        url = _CAL_URL
         params={'sb':'p', 'd':day_num, 't':'all'}
-    
-    headers={'user_agent':('Mozilla/5.0 (Windows NT 6.1; Win64; x64)'
-             'AppleWebKit/537.36 (KHTML, like Gecko) Chrome/67.0.3396.99 Safari/537.36')}
-    r = requests.get(url, params=params, headers=headers)
+
+    headers = _conditional_headers(cache_path) if cached_exists else {}
+
+    try:
+        r = _SESSION.get(url, params=params, headers=headers)
+        # A transient error page must never be cached or parsed;
+        # raising here sends HTTP errors down the stale-fallback
+        # path as well (304 is below 400 and does not raise)
+        r.raise_for_status()
+    except requests.RequestException:
+        # Stale fallback: a stale copy beats no calendar at all
+        if cached_exists:
+            return _read_cache(cache_path)
+        raise
+
+    if r.status_code == 304:
+        # Upstream unchanged; restart the ttl clock on the cached copy
+        os.utime(cache_path, None)
+        return _read_cache(cache_path)
+
+    _ensure_cache_dir()
+    with io.open(cache_path, 'w', encoding='utf-8') as cached:
+        cached.write(r.text)
+    with open(_meta_path(cache_path), 'w') as meta_file:
+        json.dump({'etag': r.headers.get('ETag'),
+                   'last_modified': r.headers.get('Last-Modified')},
+                  meta_file)
+
     return r.text
 
+# Pulls hour and AM/PM out of strings like "7:30 AM ET"
+_TIME_RE = re.compile(r'(\d{1,2}):\d{2}\s*([AP])M')
+
+# Short labels the calendar uses instead of a clock time
+_SHORT_LABELS = {'BMO': 'BTO', 'AMC': 'ATC', 'DMH': 'DMH'}
+
 def _is_BTO_or_ATC(time_string):
     """Based on time, determine if earnings are before, during, or
     after market hours.
@@ -55,54 +165,91 @@ def _is_BTO_or_ATC(time_string):
         String representing whether company reported before, during, or after
         market.
     """
-    try:
-        time = dt.datetime.strptime(time_string[:-3], '%I:%M %p')
-    except ValueError:
-        if time_string=='BMO':
-            return 'BTO'
-        if time_string=='AMC':
-            return 'ATC'
-        if time_string=='DMH':
-            return 'DMH'
+    if time_string in _SHORT_LABELS:
+        return _SHORT_LABELS[time_string]
+
+    match = _TIME_RE.match(time_string)
+    if match is None:
         return "n/a"
+
+    hour = int(match.group(1)) % 12
+    if match.group(2) == 'P':
+        hour += 12
+
+    if hour < 10:
+        return "BTO"
+    elif hour >= 16:
+        return "ATC"
     else:
-        if time.hour < 10:
-            return "BTO"
-        elif time.hour >= 16:
-            return "ATC"
-        elif time.hour >= 10 and time.hour <16:
-            return 'DMH'
-        else:
-            return "n/a"
-
-def _find_symbols_and_times(soup):
-    """Return all tickers and earnings times given a soup object
-    composed of the earningswhispers.com calendar web page
+        return "DMH"
+
+def _classify_times(times):
+    """Vectorized version of _is_BTO_or_ATC over a whole list of
+    time strings.
+
+    Parameters:
+    -----------
+    times: list of strings
+        time strings of the form "7:30 AM ET" (or the short labels
+        "BMO"/"AMC"/"DMH")
+
+    Returns
+    -------
+    list of strings
+        BTO/ATC/DMH/"n/a" label for each input time
+    """
+    raw = pd.Series(list(times), dtype=object)
+
+    # Strip the trailing " ET" and parse every clock time in one pass;
+    # unparseable entries coerce to NaT and fall through to 'n/a'
+    hours = pd.to_datetime(raw.str[:-3], format='%I:%M %p',
+                           errors='coerce').dt.hour
+    labels = np.select([hours < 10, hours >= 16,
+                        (hours >= 10) & (hours < 16)],
+                       ['BTO', 'ATC', 'DMH'], default='n/a')
+
+    # The short labels are not clock times; map them directly
+    labels = np.where(raw.eq('BMO'), 'BTO',
+             np.where(raw.eq('AMC'), 'ATC',
+             np.where(raw.eq('DMH'), 'DMH', labels)))
+
+    return labels.tolist()
+
+# XPaths matching calendar entries by class, whole-word so e.g.
+# class="ticker small" still matches but "tickerx" does not.
+_CLASS_XPATH = ('//ul[@id="epscalendar"]'
+                '//*[contains(concat(" ", normalize-space(@class), " "),'
+                ' " {0} ")]')
+_TICKER_XPATH = _CLASS_XPATH.format('ticker')
+_TIME_XPATH = _CLASS_XPATH.format('time')
+
+def _find_symbols_and_times(html_text):
+    """Return all tickers and earnings times given the html text of
+    the earningswhispers.com calendar web page
 
     Parameters
     ----------
-    soup: BeautifulSoup object
-        contains html page of earnings calendar
+    html_text: string
+        html page of earnings calendar
 
     Returns
     -------
     list of tuples:
         (ticker, is_bto_or_atc, times)
     """
-    calendar = soup.find('ul', id="epscalendar")
-    tickers = calendar.find_all(class_='ticker')
-    times = calendar.find_all(class_='time')
-    mapper = lambda x: x.text
+    root = html.fromstring(html_text)
 
-    tickers = map(mapper, tickers)
-    times = map(mapper, times)
+    # text_content() gathers descendant text too, so entries wrapped
+    # in nested elements (links etc.) yield exactly one string each
+    tickers = [el.text_content() for el in root.xpath(_TICKER_XPATH)]
+    times = [el.text_content() for el in root.xpath(_TIME_XPATH)]
 
     # Set times to none if times do not align with tickers
     if len(tickers) != len(times):
         times=['n/a']*len(tickers)
         is_bto_or_atc = ['n/a']*len(tickers)
     else:
-        is_bto_or_atc = map(_is_BTO_or_ATC, times)
+        is_bto_or_atc = _classify_times(times)
 
     return zip(tickers, is_bto_or_atc, times )
 
@@ -123,14 +270,47 @@ def fetch_all_earnings_and_times(n_days, start_day=1):
         {earnings_date: list of earnings calendar data returned
                         from _find_symbols_and_times()}
     """
+    days = range(start_day, n_days + start_day)
+
+    # Fetch all day pages concurrently; the wait is network bound, so
+    # threads collapse the wall time to roughly one round-trip.
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        pages = list(executor.map(_get_page, days))
+
+    # Build all business-day dates in one vectorized call rather than
+    # one BDay offset per loop iteration
+    today = dt.datetime.today()
+    dates = pd.bdate_range(today + BDay(start_day), periods=n_days)
+
     calendar_dict = {}
-    for day in range(start_day, n_days + start_day):
-        soup = BeautifulSoup(_get_page(day), 'html.parser')
-        date = dt.datetime.today() + BDay(day)
-        calendar_dict[date] = _find_symbols_and_times(soup)
+    for date, page in zip(dates, pages):
+        calendar_dict[date] = _find_symbols_and_times(page)
 
     return calendar_dict
 
+def build_calendar_df(calendar_dict):
+    """Build the earnings calendar DataFrame from calendar_dict.
+
+    Parameters
+    ----------
+    calendar_dict: dict
+        {earnings_date: list of earnings calendar data returned
+                        from _find_symbols_and_times()}
+
+    Returns
+    -------
+    DataFrame
+        earnings calendar with Date/Symbol/BTO-ATC/Time columns
+    """
+    rows = []
+    for date in sorted(calendar_dict.keys()):
+        str_date = date.strftime('%a, %m/%d/%Y')
+        for row in calendar_dict[date]:
+            rows.append((str_date,) + tuple(row))
+
+    return pd.DataFrame(rows, columns=['Date', 'Symbol',
+                                       'BTO/ATC', 'Time'])
+
 def write_to_file(calendar_dict, file_base_name='earnings_calendar',
                   dest_path='./Earnings Calendar Files'):
     """Write earnings calendar to csv file.
@@ -149,6 +329,9 @@ def write_to_file(calendar_dict, file_base_name='earnings_calendar',
     --------
     file_path: string
         path of the destination file
+    calendar_df: DataFrame
+        the written calendar, so callers can keep working on it
+        without re-reading the file
     """
     sorted_dates = sorted(calendar_dict.keys())
     start_date_str =  sorted_dates[0].strftime('%Y%m%d')
@@ -156,31 +339,40 @@ def write_to_file(calendar_dict, file_base_name='earnings_calendar',
 
     file_name = (file_base_name + '_'+ start_date_str + '-' +
                  end_date_str )
-    file_path = os.path.join(dest_path, file_name + '.csv' )
 
+    # List the destination once and probe for a free name in memory
+    # instead of a stat syscall per collision candidate
+    if os.path.isdir(dest_path):
+        existing = set(os.listdir(dest_path))
+    else:
+        existing = set()
+
+    candidate = file_name + '.csv'
     i = 1
-    while os.path.exists(file_path):
-        file_path = os.path.join(dest_path,
-                                 file_name + '({})'.format(i)+'.csv')
+    while candidate in existing:
+        candidate = file_name + '({0})'.format(i) + '.csv'
         i+=1
+    file_path = os.path.join(dest_path, candidate)
+
+    calendar_df = build_calendar_df(calendar_dict)
+    calendar_df.to_csv(file_path, index=False)
 
-    with open(file_path, 'wb') as csvfile:
-        writer = csv.writer(csvfile, delimiter=',')
-        writer.writerow(['Date', 'Symbol', 'BTO/ATC','Time'])
-        for date in sorted_dates:
-            for row in calendar_dict[date]:
-                str_date = date.strftime('%a, %m/%d/%Y')
-                writer.writerow((str_date,) + row)
+    return file_path, calendar_df
 
-    return file_path
+def append_data_to_file(file_name, fields=['price', 'average_volume_30'],
+                        earnings_cal_df=None):
+    """Append data fields columns to an Earnings Calendar csv file.
 
-def append_data_to_file(file_name, fields=['price', 'average_volume_30']):
-    """Read in an Earnings Calendar csv file. Append data fields columns.
-    Then, rewrite to file"""
+    If the calendar DataFrame is already in memory (e.g. just
+    returned by write_to_file), pass it as earnings_cal_df to skip
+    re-reading the file; otherwise it is read from file_name."""
 
-    earnings_cal_df = pd.read_csv(file_name)
+    if earnings_cal_df is None:
+        earnings_cal_df = pd.read_csv(file_name)
 
-    symbols = earnings_cal_df['Symbol'].tolist()
+    # A ticker reporting on multiple days only needs one API lookup;
+    # the left merge broadcasts it back to every occurrence
+    symbols = earnings_cal_df['Symbol'].drop_duplicates().tolist()
     cc = data_fetcher.CompanyClient(symbols)
     data_df = cc.to_dataframe(cc.fetch_data(fields))
 
@@ -220,8 +412,8 @@ if __name__=='__main__':
                 start_day = int(arg)
 
     earnings_calendar = fetch_all_earnings_and_times(days_to_fetch, start_day)
-    file_path = write_to_file(earnings_calendar)
+    file_path, calendar_df = write_to_file(earnings_calendar)
 
     data_fields = ['price', 'average_volume_30']
-    append_data_to_file(file_path, data_fields)
+    append_data_to_file(file_path, data_fields, calendar_df)
 